@@ -1,80 +1,333 @@
+import asyncio
 import datetime
+import email.utils
+import hashlib
 import itertools
-import json
 import logging
 import os
 import time
 import urllib.parse
-from concurrent.futures import ThreadPoolExecutor
-from dataclasses import dataclass
+from collections.abc import Iterable
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from operator import attrgetter
+from xml.etree import ElementTree
 
 import feedparser
-import requests
-from jinja2 import Environment, FileSystemLoader
+import httpx
+import orjson
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader, Template
 
 BASE_DIR = os.path.dirname(os.path.realpath(__file__))
 PARENT_DIR = os.path.dirname(BASE_DIR)
 LINKS_DIR = os.path.join(PARENT_DIR, "content", "links")
 FEEDS_FILE = "feeds.json"
+FEED_CACHE_FILE = "feed_cache.json"
+STATE_FILE = ".links_updater_state.json"
+FETCH_CONCURRENCY = int(os.environ.get("LINKS_UPDATER_FETCH_CONCURRENCY", 20))
+FETCH_TIMEOUT = 10
+# Nothing we follow comes close. This protects us from broken or hostile servers.
+MAX_FEED_SIZE = 10 * 1024 * 1024
+# Parsing is CPU-bound pure Python, so it's done in processes.
+PARSE_WORKERS = os.cpu_count() or 1
+WRITE_WORKERS = 8
+
+ATOM_NS = "{http://www.w3.org/2005/Atom}"
+XML_CHUNK_SIZE = 64 * 1024
+HTML_TYPES = ("text/html", "application/xhtml+xml")
+# Short forms of link types, as understood by feedparser.
+LINK_TYPES = {"html": "text/html", "xhtml": "application/xhtml+xml"}
+MONTHS = (
+    "January",
+    "February",
+    "March",
+    "April",
+    "May",
+    "June",
+    "July",
+    "August",
+    "September",
+    "October",
+    "November",
+    "December",
+)
 
 TEMPLATES_DIR = os.path.join(BASE_DIR, "templates")
-JINJA_ENV = Environment(loader=FileSystemLoader(TEMPLATES_DIR), autoescape=True)
+# links_updater runs as a new process every time, so keep compiled templates
+# on disk. By default, they go to a per-user directory under the system tempdir.
+JINJA_ENV = Environment(
+    loader=FileSystemLoader(TEMPLATES_DIR),
+    autoescape=True,
+    bytecode_cache=FileSystemBytecodeCache(),
+)
 
 
-@dataclass
+@dataclass(slots=True)
 class Feed:
     url: str
-    content: str
+    # Raw bytes, so that the parsers take the encoding from the XML declaration.
+    content: bytes
+    etag: str | None = None
+    last_modified: str | None = None
+    # Set when the server answered 304 to a conditional GET.
+    # The links are then taken from the feed cache.
+    not_modified: bool = False
 
 
-@dataclass
+@dataclass(slots=True)
 class Link:
     domain: str
     title: str
     url: str
     published: datetime.datetime
     num: int
+    # Computed once, so that grouping doesn't call .date() on every link.
+    published_date: datetime.date = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        self.published_date = self.published.date()
+
+
+# Maps feed url to
+# {"etag": ..., "last_modified": ..., "content_hash": ..., "links": [...]}.
+FeedCache = dict[str, dict]
 
 
 def update_links():
     feeds_urls = get_feeds_urls()
-    feeds = get_feeds(feeds_urls)
-    rendered_pages = render_pages_from_feeds(feeds)
-    write_pages(rendered_pages)
+    cache = load_json_file(FEED_CACHE_FILE)
+    feeds = get_feeds(feeds_urls, cache)
+
+    state = load_json_file(STATE_FILE)
+    fingerprint = get_feeds_fingerprint(feeds_urls, feeds, cache)
+    if state.get("fingerprint") == fingerprint and os.path.exists(LINKS_DIR):
+        logging.info("Feeds haven't changed, nothing to render")
+        update_cached_validators(feeds, cache)
+    else:
+        rendered_pages = render_pages_from_feeds(feeds, cache)
+        write_pages(rendered_pages)
+    save_json_file(
+        FEED_CACHE_FILE, {url: cache[url] for url in feeds_urls if url in cache}
+    )
+    save_json_file(STATE_FILE, {"fingerprint": fingerprint})
 
 
 def get_feeds_urls() -> list[str]:
-    with open(os.path.join(BASE_DIR, FEEDS_FILE)) as f:
-        return json.load(f)
+    with open(os.path.join(BASE_DIR, FEEDS_FILE), "rb") as f:
+        return orjson.loads(f.read())
+
+
+def load_json_file(filename: str) -> dict:
+    try:
+        with open(os.path.join(BASE_DIR, filename), "rb") as f:
+            return orjson.loads(f.read())
+    except FileNotFoundError:
+        return {}
+    except ValueError:
+        logging.warning(f"Invalid {filename}, ignoring it")
+        return {}
+
 
+def save_json_file(filename: str, data: dict):
+    with open(os.path.join(BASE_DIR, filename), "wb") as f:
+        f.write(orjson.dumps(data))
 
-def get_feeds(feeds_urls: list[str]) -> list[Feed]:
-    with ThreadPoolExecutor(20) as p:
-        feeds = p.map(get_feed, feeds_urls)
+
+def update_cached_validators(feeds: list[Feed], cache: FeedCache):
+    """
+    Servers may send a new ETag or Last-Modified with the same body
+    (e.g. different ones from each server behind a load balancer).
+    Remember the latest ones, so that the next conditional GET can succeed.
+    """
+    for feed in feeds:
+        cached = cache.get(feed.url)
+        if feed.not_modified or cached is None:
+            continue
+        if cached.get("content_hash") == get_content_hash(feed.content):
+            cached["etag"] = feed.etag
+            cached["last_modified"] = feed.last_modified
+
+
+def get_feeds_fingerprint(
+    feeds_urls: list[str], feeds: list[Feed], cache: FeedCache
+) -> str:
+    """
+    Identifies the set of feeds and their contents,
+    so that we can tell if anything changed since the last run.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    for url in feeds_urls:
+        h.update(f"{url}\n".encode())
+    for feed in sorted(feeds, key=attrgetter("url")):
+        if feed.not_modified:
+            content_hash = cache[feed.url]["content_hash"]
+        else:
+            content_hash = get_content_hash(feed.content)
+        h.update(f"{feed.url}:{content_hash}\n".encode())
+    return h.hexdigest()
+
+
+def get_feeds(feeds_urls: list[str], cache: FeedCache | None = None) -> list[Feed]:
+    feeds = asyncio.run(get_feeds_async(feeds_urls, cache))
     return [feed for feed in feeds if feed is not None]
 
 
-def get_feed(feed_url: str) -> Feed | None:
+async def get_feeds_async(
+    feeds_urls: list[str], cache: FeedCache | None = None
+) -> list[Feed | None]:
+    # All feeds are fetched concurrently on one thread. The connection pool
+    # limits how many requests are in flight; the rest wait for a connection
+    # (hence no pool timeout). With HTTP/2, requests to the same host are
+    # multiplexed over a single connection.
+    transport = httpx.AsyncHTTPTransport(
+        http2=True,
+        retries=3,
+        limits=httpx.Limits(
+            max_connections=FETCH_CONCURRENCY,
+            max_keepalive_connections=FETCH_CONCURRENCY,
+        ),
+    )
+    async with httpx.AsyncClient(
+        transport=transport,
+        timeout=httpx.Timeout(FETCH_TIMEOUT, pool=None),
+        follow_redirects=True,
+    ) as client:
+        return await asyncio.gather(
+            *(get_feed(client, feed_url, cache) for feed_url in feeds_urls)
+        )
+
+
+async def get_feed(
+    client: httpx.AsyncClient, feed_url: str, cache: FeedCache | None = None
+) -> Feed | None:
+    headers = get_conditional_headers(feed_url, cache)
+    # InvalidURL isn't an HTTPError, but a malformed url in feeds.json
+    # shouldn't stop the other feeds from updating.
     try:
-        response = requests.get(feed_url)
-    except requests.exceptions.RequestException:
+        async with client.stream("GET", feed_url, headers=headers) as response:
+            content = await read_content(response)
+    except (httpx.HTTPError, httpx.InvalidURL):
         logging.warning(f"Cannot get feed: {feed_url}")
         return None
-    return Feed(url=feed_url, content=response.text)
+    if content is None:
+        logging.warning(f"Feed is larger than {MAX_FEED_SIZE} bytes: {feed_url}")
+        return None
+    return Feed(
+        url=feed_url,
+        content=content,
+        etag=response.headers.get("ETag"),
+        last_modified=response.headers.get("Last-Modified"),
+        not_modified=bool(headers) and response.status_code == 304,
+    )
 
 
-def render_pages_from_feeds(feeds: list[Feed]) -> list[str]:
-    links = get_links(feeds)
+async def read_content(response: httpx.Response) -> bytes | None:
+    """
+    Read the response body, giving up as soon as it exceeds MAX_FEED_SIZE,
+    so that we never hold more than that in memory per feed.
+    """
+    if int(response.headers.get("Content-Length", 0)) > MAX_FEED_SIZE:
+        return None
+    chunks = []
+    size = 0
+    async for chunk in response.aiter_bytes():
+        size += len(chunk)
+        if size > MAX_FEED_SIZE:
+            return None
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+def get_conditional_headers(
+    feed_url: str, cache: FeedCache | None = None
+) -> dict[str, str]:
+    if cache is None or feed_url not in cache:
+        return {}
+    headers = {}
+    if cache[feed_url].get("etag"):
+        headers["If-None-Match"] = cache[feed_url]["etag"]
+    if cache[feed_url].get("last_modified"):
+        headers["If-Modified-Since"] = cache[feed_url]["last_modified"]
+    return headers
+
+
+def render_pages_from_feeds(
+    feeds: list[Feed], cache: FeedCache | None = None
+) -> list[str]:
+    links = get_links(feeds, cache)
     pages = get_pages(links)
     return render_pages(pages)
 
 
-def get_links(feeds: list[Feed]) -> list[Link]:
-    return [link for feed in feeds for link in get_links_from_feed(feed)]
+def get_links(feeds: list[Feed], cache: FeedCache | None = None) -> list[Link]:
+    links_by_feeds = [get_cached_links(feed, cache) for feed in feeds]
+    parsed_links = iter(
+        parse_feeds([f for f, links in zip(feeds, links_by_feeds) if links is None])
+    )
+    for i, feed in enumerate(feeds):
+        if links_by_feeds[i] is None:
+            links_by_feeds[i] = next(parsed_links)
+        update_feed_cache(feed, links_by_feeds[i], cache)
+    return list(itertools.chain.from_iterable(links_by_feeds))
+
+
+def get_links_from_feed(feed: Feed, cache: FeedCache | None = None) -> list[Link]:
+    links = get_cached_links(feed, cache)
+    if links is None:
+        links = parse_links_from_feed(feed)
+    update_feed_cache(feed, links, cache)
+    return links
 
 
-def get_links_from_feed(feed: Feed) -> list[Link]:
-    feed_dict = feedparser.parse(feed.content)
+def get_cached_links(feed: Feed, cache: FeedCache | None = None) -> list[Link] | None:
+    cached = cache.get(feed.url) if cache is not None else None
+    if cached is None:
+        return None
+    # Many servers don't support conditional GETs and return
+    # the same body every time, so don't parse it again.
+    if feed.not_modified or cached.get("content_hash") == get_content_hash(
+        feed.content
+    ):
+        return [deserialize_link(link) for link in cached["links"]]
+    return None
+
+
+def update_feed_cache(feed: Feed, links: list[Link], cache: FeedCache | None = None):
+    if cache is None:
+        return
+    if feed.not_modified:
+        # Keep the validators and the hash of the body we actually parsed.
+        return
+    cache[feed.url] = {
+        "etag": feed.etag,
+        "last_modified": feed.last_modified,
+        "content_hash": get_content_hash(feed.content),
+        "links": [serialize_link(link) for link in links],
+    }
+
+
+def parse_feeds(feeds: list[Feed]) -> list[list[Link]]:
+    if PARSE_WORKERS < 2 or len(feeds) < 2:
+        # Not worth starting processes.
+        return [parse_links_from_feed(feed) for feed in feeds]
+    with ProcessPoolExecutor(min(PARSE_WORKERS, len(feeds))) as p:
+        return list(p.map(parse_links_from_feed, feeds))
+
+
+def get_content_hash(content: bytes) -> str:
+    return hashlib.blake2b(content, digest_size=16).hexdigest()
+
+
+def parse_links_from_feed(feed: Feed) -> list[Link]:
+    links = parse_feed_fast(feed.content)
+    if links is not None:
+        return filter_bad_links(links)
+
+    # We only use titles, links and dates, and Jinja autoescapes titles,
+    # so sanitizing HTML and resolving relative URIs in content is wasted work.
+    feed_dict = feedparser.parse(
+        feed.content, sanitize_html=False, resolve_relative_uris=False
+    )
 
     if feed_dict.bozo:
         # Handles only bad-formed XML.
@@ -89,6 +342,160 @@ def get_links_from_feed(feed: Feed) -> list[Link]:
     return filter_bad_links(links)
 
 
+def parse_feed_fast(content: bytes) -> list[Link] | None:
+    """
+    Extract links from plain Atom and RSS 2.0 feeds without feedparser,
+    which is slow and builds a lot of stuff we don't use.
+    Returns None if the feed is malformed, of some other format
+    or has anything unusual, so that feedparser handles it.
+    """
+    try:
+        return _parse_feed_fast(content)
+    except (ElementTree.ParseError, ValueError, TypeError):
+        return None
+
+
+def _parse_feed_fast(content: bytes) -> list[Link] | None:
+    parser = ElementTree.XMLPullParser(events=("start", "end"))
+    path = []
+    parents = []
+    feed_links = []
+    feed_link = None
+    entries = []
+
+    def events():
+        for i in range(0, len(content), XML_CHUNK_SIZE):
+            parser.feed(content[i : i + XML_CHUNK_SIZE])
+            yield from parser.read_events()
+        parser.close()
+        yield from parser.read_events()
+
+    for event, elem in events():
+        if event == "start":
+            path.append(elem.tag)
+            parents.append(elem)
+            if len(path) == 1 and elem.tag not in (f"{ATOM_NS}feed", "rss"):
+                return None
+            continue
+
+        path.pop()
+        parents.pop()
+        if path == [f"{ATOM_NS}feed"]:
+            if elem.tag == f"{ATOM_NS}link":
+                feed_links.append(elem)
+            elif elem.tag == f"{ATOM_NS}entry":
+                entries.append(parse_atom_entry(elem))
+                # Processed entries aren't needed anymore.
+                parents[-1].remove(elem)
+        elif path == ["rss", "channel"]:
+            if elem.tag == "link":
+                # feedparser takes the last one.
+                feed_link = (elem.text or "").strip()
+            elif elem.tag == f"{ATOM_NS}link" and is_html_alternate(elem):
+                # feedparser would take this one as the feed link instead.
+                return None
+            elif elem.tag == "item":
+                entries.append(parse_rss_item(elem))
+                parents[-1].remove(elem)
+
+    if feed_links:
+        feed_link = get_atom_link(feed_links)
+    if not feed_link or not is_absolute_url(feed_link) or None in entries:
+        return None
+    domain = get_domain(feed_link)
+    return [
+        Link(domain=domain, title=title, url=url, published=published, num=0)
+        for title, url, published in entries
+    ]
+
+
+def parse_atom_entry(
+    entry: ElementTree.Element,
+) -> tuple[str, str, datetime.datetime] | None:
+    title = get_plain_text(entry.find(f"{ATOM_NS}title"))
+    url = get_atom_link(entry.iterfind(f"{ATOM_NS}link"))
+    # feedparser prefers "published" over "updated", so do we.
+    date = entry.findtext(f"{ATOM_NS}published") or entry.findtext(f"{ATOM_NS}updated")
+    if title is None or url is None or not is_absolute_url(url) or not date:
+        return None
+    published = datetime.datetime.fromisoformat(date.strip())
+    return title, url, struct_time_to_datetime(published.utctimetuple())
+
+
+def parse_rss_item(
+    item: ElementTree.Element,
+) -> tuple[str, str, datetime.datetime] | None:
+    title = get_plain_text(item.find("title"))
+    links = item.findall("link")
+    url = (links[-1].text or "").strip() if links else ""
+    date = item.findtext("pubDate")
+    if any(is_html_alternate(link) for link in item.iterfind(f"{ATOM_NS}link")):
+        return None
+    if title is None or not is_absolute_url(url) or not date:
+        return None
+    published = email.utils.parsedate_to_datetime(date.strip())
+    return title, url, struct_time_to_datetime(published.utctimetuple())
+
+
+def get_atom_link(links: Iterable[ElementTree.Element]) -> str | None:
+    """
+    Return the href of the link feedparser would pick:
+    the last alternate link to an HTML page.
+    """
+    url = None
+    for link in links:
+        if is_html_alternate(link):
+            url = link.get("href")
+    return url
+
+
+def is_html_alternate(link: ElementTree.Element) -> bool:
+    # Like feedparser, treat a missing rel as "alternate"
+    # and a missing type as "text/html".
+    if link.get("rel", "alternate") != "alternate":
+        return False
+    link_type = link.get("type", "text/html").lower()
+    return LINK_TYPES.get(link_type, link_type) in HTML_TYPES
+
+
+def get_plain_text(elem: ElementTree.Element | None) -> str | None:
+    """
+    Return the element's text if it needs no HTML processing.
+    feedparser decodes titles with markup or entities,
+    so we leave those to it.
+    """
+    if elem is None or len(elem) > 0:
+        return None
+    text = (elem.text or "").strip()
+    if "<" in text or "&" in text:
+        return None
+    return text
+
+
+def is_absolute_url(url: str) -> bool:
+    parsed_url = urllib.parse.urlparse(url)
+    return bool(parsed_url.scheme and parsed_url.netloc)
+
+
+def serialize_link(link: Link) -> dict:
+    return {
+        "domain": link.domain,
+        "title": link.title,
+        "url": link.url,
+        "published": link.published.isoformat(),
+    }
+
+
+def deserialize_link(link_dict: dict) -> Link:
+    return Link(
+        domain=link_dict["domain"],
+        title=link_dict["title"],
+        url=link_dict["url"],
+        published=datetime.datetime.fromisoformat(link_dict["published"]),
+        num=0,
+    )
+
+
 def valid_feed(feed_dict: feedparser.FeedParserDict) -> bool:
     if "link" not in feed_dict.feed:
         logging.warning(f'Feed has no "link" attribute: {feed_dict}')
@@ -170,7 +577,10 @@ def get_pages(links: list[Link]) -> list[dict[str, list[Link]]]:
 
 
 def sort_links(links: list[Link]) -> list[Link]:
-    sorted_links = sorted(links, key=lambda link: link.published, reverse=True)
+    # Links come feed by feed, and each feed is usually ordered by date.
+    # Timsort detects these runs and merges them, which is faster than
+    # merging the feeds with heapq.merge() in Python.
+    sorted_links = sorted(links, key=attrgetter("published"), reverse=True)
     for i, link in enumerate(sorted_links, start=1):
         link.num = i
     return sorted_links
@@ -178,25 +588,30 @@ def sort_links(links: list[Link]) -> list[Link]:
 
 def group_links_by_pages(
     links: list[Link], links_per_page: int = 30
-) -> list[list[Link]]:
-    links_by_pages = []
-    last_link = 0
-    while last_link < len(links):
-        links_by_pages.append(links[last_link : last_link + links_per_page])
-        last_link += links_per_page
-    return links_by_pages
+) -> list[tuple[Link, ...]]:
+    # Pages are only iterated over once, in group_links_by_date(),
+    # so there's no need to copy batched() tuples into lists.
+    return list(itertools.batched(links, links_per_page))
 
 
-def group_links_by_date(links: list[Link]) -> dict[str, list[Link]]:
-    groups = itertools.groupby(links, key=lambda link: link.published.date())
-    return {date.strftime("%B %-d, %-Y"): list(g) for date, g in groups}
+def group_links_by_date(links: Iterable[Link]) -> dict[str, list[Link]]:
+    groups = itertools.groupby(links, key=attrgetter("published_date"))
+    return {format_date(date): list(g) for date, g in groups}
+
+
+def format_date(date: datetime.date) -> str:
+    # Same as strftime("%B %-d, %-Y") but portable and locale-independent.
+    return f"{MONTHS[date.month - 1]} {date.day}, {date.year}"
 
 
 def render_pages(pages: list[dict[str, list[Link]]]) -> list[str]:
     now = datetime.datetime.now(tz=datetime.timezone.utc)
+    first_page_template = JINJA_ENV.get_template("links-page-1.md.jinja2")
+    page_n_template = JINJA_ENV.get_template("links-page-n.md.jinja2")
     rendered_pages = []
     for i, link_groups in enumerate(pages, start=1):
-        rendered_pages.append(render_page(i, link_groups, pages, now))
+        template = first_page_template if i == 1 else page_n_template
+        rendered_pages.append(render_page(i, link_groups, pages, now, template))
     return rendered_pages
 
 
@@ -205,12 +620,11 @@ def render_page(
     link_groups: dict[str, list[Link]],
     pages: list[dict[str, list[Link]]],
     updated: datetime.datetime,
+    template: Template,
 ) -> str:
     if page_num == 1:
-        template = JINJA_ENV.get_template("links-page-1.md.jinja2")
         prev = None
     else:
-        template = JINJA_ENV.get_template("links-page-n.md.jinja2")
         prev = f"{{filename}}/links/page-{page_num - 1}.md"
     if page_num < len(pages):
         next = f"{{filename}}/links/page-{page_num + 1}.md"
@@ -232,9 +646,17 @@ def write_pages(rendered_pages: list[str]):
     if not os.path.exists(LINKS_DIR):
         os.mkdir(LINKS_DIR)
 
-    for i, rendered_page in enumerate(rendered_pages, start=1):
-        with open(os.path.join(LINKS_DIR, f"page-{i}.md"), "w+") as f:
-            f.write(rendered_page)
+    with ThreadPoolExecutor(WRITE_WORKERS) as p:
+        list(p.map(write_page, itertools.count(1), rendered_pages))
+
+
+def write_page(page_num: int, rendered_page: str):
+    path = os.path.join(LINKS_DIR, f"page-{page_num}.md")
+    # Write to a temporary file first so that pelican never sees a partial page.
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(rendered_page)
+    os.replace(tmp_path, path)
 
 
 if __name__ == "__main__":
@@ -1,6 +1,8 @@
+import asyncio
 import datetime
 import os
 
+import httpx
 import pytest
 
 import links_updater
@@ -30,11 +32,22 @@ def load_feed(filename):
         return f.read()
 
 
+def load_feed_bytes(filename):
+    filepath = os.path.join(BASE_DIR, SAMPLE_FEEDS_DIR, filename)
+    with open(filepath, 'rb') as f:
+        return f.read()
+
+
 @pytest.fixture(scope='session')
 def atom_feed():
     return load_feed('atom1.0.xml')
 
 
+@pytest.fixture(scope='session')
+def atom_feed_bytes():
+    return load_feed_bytes('atom1.0.xml')
+
+
 @pytest.fixture(scope='session')
 def malicious_feed():
     return load_feed('malicious.xml')
@@ -56,6 +69,12 @@ def test_get_feeds_bad_url():
     assert feeds == []
 
 
+@pytest.mark.parametrize('feed_url', ['http://[::1', 'badurl/feed.xml'])
+def test_get_feeds_malformed_url(feed_url):
+    feeds = links_updater.get_feeds([feed_url])
+    assert feeds == []
+
+
 def test_render_empty_feed():
     feed = ''
     rendered_pages = links_updater.render_pages_from_feeds([feed])
@@ -140,3 +159,221 @@ def test_bad_links_are_filtered():
     }]
     filtered_links = links_updater.filter_bad_links(links)
     assert filtered_links == links[:1]
+
+
+def test_parsed_links_are_cached(atom_feed_bytes):
+    cache = {}
+    feed = links_updater.Feed(
+        url='http://example.org/feed.xml', content=atom_feed_bytes, etag='"abc"'
+    )
+    links = links_updater.get_links_from_feed(feed, cache)
+    assert cache[feed.url]['etag'] == '"abc"'
+    assert len(cache[feed.url]['links']) == len(links) == 2
+
+
+def test_not_modified_feed_uses_cache(atom_feed_bytes):
+    cache = {}
+    feed = links_updater.Feed(url='http://example.org/feed.xml', content=atom_feed_bytes)
+    links = links_updater.get_links_from_feed(feed, cache)
+
+    not_modified_feed = links_updater.Feed(
+        url=feed.url, content=b'', not_modified=True
+    )
+    assert links_updater.get_links_from_feed(not_modified_feed, cache) == links
+
+
+def test_conditional_headers():
+    cache = {'http://example.org/feed.xml': {
+        'etag': '"abc"',
+        'last_modified': 'Sat, 13 Dec 2003 18:30:02 GMT',
+        'links': [],
+    }}
+    headers = links_updater.get_conditional_headers(
+        'http://example.org/feed.xml', cache
+    )
+    assert headers == {
+        'If-None-Match': '"abc"',
+        'If-Modified-Since': 'Sat, 13 Dec 2003 18:30:02 GMT',
+    }
+    assert links_updater.get_conditional_headers('http://other.org', cache) == {}
+
+
+def test_unchanged_feed_is_not_parsed_again(atom_feed_bytes, monkeypatch):
+    cache = {}
+    feed = links_updater.Feed(url='http://example.org/feed.xml', content=atom_feed_bytes)
+    links = links_updater.get_links_from_feed(feed, cache)
+
+    def fail(*args, **kwargs):
+        raise AssertionError('feed should not be parsed')
+
+    monkeypatch.setattr(links_updater, 'parse_links_from_feed', fail)
+    assert links_updater.get_links_from_feed(feed, cache) == links
+
+
+def test_get_links_from_many_feeds(atom_feed_bytes):
+    cache = {}
+    feeds = [
+        links_updater.Feed(url=f'http://example.org/feed{i}.xml', content=atom_feed_bytes)
+        for i in range(4)
+    ]
+    links = links_updater.get_links(feeds, cache)
+    assert len(links) == 8
+    assert [link.title for link in links[:2]] == ['Entry 1', 'Entry 2']
+    assert set(cache) == {feed.url for feed in feeds}
+
+
+@pytest.mark.parametrize(
+    'filename', ['atom1.0.xml', 'atom1.0_alternates.xml', 'rss2.0.xml']
+)
+def test_parse_feed_fast(filename):
+    links = links_updater.parse_feed_fast(load_feed_bytes(filename))
+    assert [link.title for link in links] == ['Entry 1', 'Entry 2']
+    assert links[0].domain == 'example.org'
+    assert links[0].url == 'http://example.org/entry1'
+    assert links[0].published == datetime.datetime(2003, 12, 13, 18, 30)
+    assert links[1].published == datetime.datetime(2003, 12, 13, 18, 45)
+
+
+@pytest.mark.parametrize(
+    'filename',
+    ['malicious.xml', 'incomplete.xml', 'bad_url.xml', 'rss2.0_atom_link.xml']
+)
+def test_parse_feed_fast_leaves_unusual_feeds_to_feedparser(filename):
+    assert links_updater.parse_feed_fast(load_feed_bytes(filename)) is None
+
+
+def test_get_pages():
+    links = [links_updater.Link(
+        domain='example.org',
+        title=f'link {i}',
+        url=f'http://example.org/link{i}',
+        published=datetime.datetime(2003, 1, 1 + i // 2, 18, i),
+        num=0,
+    ) for i in range(5)]
+    pages = links_updater.get_pages(links)
+    assert len(pages) == 1
+    assert list(pages[0]) == ['January 3, 2003', 'January 2, 2003', 'January 1, 2003']
+    assert [link.title for link in pages[0]['January 3, 2003']] == ['link 4']
+    assert [link.num for group in pages[0].values() for link in group] == [
+        1, 2, 3, 4, 5
+    ]
+
+
+def test_write_pages(tmp_path, monkeypatch):
+    links_dir = tmp_path / 'links'
+    monkeypatch.setattr(links_updater, 'LINKS_DIR', str(links_dir))
+    links_updater.write_pages(['page 1', 'page 2'])
+    links_updater.write_pages(['page 1', 'new page 2'])
+    assert sorted(os.listdir(links_dir)) == ['page-1.md', 'page-2.md']
+    assert (links_dir / 'page-1.md').read_text() == 'page 1'
+    assert (links_dir / 'page-2.md').read_text() == 'new page 2'
+
+
+def test_feeds_fingerprint(atom_feed_bytes):
+    urls = ['http://example.org/feed.xml', 'http://badurl']
+    feed = links_updater.Feed(url=urls[0], content=atom_feed_bytes)
+    cache = {}
+    links_updater.get_links_from_feed(feed, cache)
+    fingerprint = links_updater.get_feeds_fingerprint(urls, [feed], cache)
+
+    not_modified_feed = links_updater.Feed(url=urls[0], content=b'', not_modified=True)
+    assert links_updater.get_feeds_fingerprint(
+        urls, [not_modified_feed], cache
+    ) == fingerprint
+
+    changed_feed = links_updater.Feed(url=urls[0], content=atom_feed_bytes + b' ')
+    assert links_updater.get_feeds_fingerprint(
+        urls, [changed_feed], cache
+    ) != fingerprint
+    assert links_updater.get_feeds_fingerprint(urls, [], cache) != fingerprint
+
+
+def get_feed_from(handler, cache=None, url='http://example.org/feed.xml'):
+    async def get():
+        transport = httpx.MockTransport(handler)
+        async with httpx.AsyncClient(transport=transport) as client:
+            return await links_updater.get_feed(client, url, cache)
+    return asyncio.run(get())
+
+
+def test_get_feed(atom_feed_bytes):
+    feed = get_feed_from(
+        lambda request: httpx.Response(
+            200, content=atom_feed_bytes, headers={'ETag': '"abc"'}
+        )
+    )
+    assert feed.content == atom_feed_bytes
+    assert feed.etag == '"abc"'
+    assert not feed.not_modified
+
+
+def test_get_feed_not_modified():
+    cache = {'http://example.org/feed.xml': {'etag': '"abc"', 'links': []}}
+
+    def handler(request):
+        assert request.headers['If-None-Match'] == '"abc"'
+        return httpx.Response(304)
+
+    assert get_feed_from(handler, cache).not_modified
+
+
+def test_get_feed_too_large(monkeypatch):
+    monkeypatch.setattr(links_updater, 'MAX_FEED_SIZE', 10)
+    assert get_feed_from(lambda request: httpx.Response(200, content=b'x' * 11)) is None
+
+
+def test_feed_encoding_is_taken_from_xml_declaration():
+    # Served without a charset, the body must not be decoded as UTF-8.
+    content = load_feed_bytes('rss2.0_latin1.xml')
+    feed = get_feed_from(
+        lambda request: httpx.Response(
+            200, content=content, headers={'Content-Type': 'application/rss+xml'}
+        )
+    )
+    assert feed.content == content
+    links = links_updater.get_links_from_feed(feed)
+    assert [link.title for link in links] == ['Café résumé naïve']
+
+
+def test_feedparser_fallback_keeps_encoding(monkeypatch):
+    monkeypatch.setattr(links_updater, 'parse_feed_fast', lambda content: None)
+    feed = links_updater.Feed(
+        url='http://example.org/feed.xml',
+        content=load_feed_bytes('rss2.0_latin1.xml'),
+    )
+    links = links_updater.get_links_from_feed(feed)
+    assert [link.title for link in links] == ['Café résumé naïve']
+
+
+def test_unchanged_feeds_update_validators(atom_feed_bytes, tmp_path, monkeypatch):
+    feed_url = 'http://example.org/feed.xml'
+    (tmp_path / 'feeds.json').write_text(f'["{feed_url}"]')
+    monkeypatch.setattr(links_updater, 'BASE_DIR', str(tmp_path))
+    monkeypatch.setattr(links_updater, 'LINKS_DIR', str(tmp_path / 'links'))
+
+    etags = iter(['"1"', '"2"'])
+    monkeypatch.setattr(links_updater, 'get_feeds', lambda urls, cache: [
+        links_updater.Feed(url=feed_url, content=atom_feed_bytes, etag=next(etags))
+    ])
+    links_updater.update_links()
+    page = (tmp_path / 'links' / 'page-1.md').read_text()
+
+    monkeypatch.setattr(links_updater, 'write_pages', lambda pages: pytest.fail())
+    links_updater.update_links()
+    cache = links_updater.load_json_file(links_updater.FEED_CACHE_FILE)
+    assert cache[feed_url]['etag'] == '"2"'
+    assert (tmp_path / 'links' / 'page-1.md').read_text() == page
+
+
+def test_group_links_by_date():
+    links = [links_updater.Link(
+        domain='example.org',
+        title=f'link {i}',
+        url=f'http://example.org/link{i}',
+        published=datetime.datetime(2003, 1, 2 - i // 2, 18, i),
+        num=0,
+    ) for i in range(3)]
+    groups = links_updater.group_links_by_date(links)
+    assert {date: len(g) for date, g in groups.items()} == {
+        'January 2, 2003': 2, 'January 1, 2003': 1
+    }